@@ -1,17 +1,49 @@
 """Configuration management for OP"""
 import copy
+import hashlib
+import importlib.util
+import json
 import logging
 import os
+import stat
+import tempfile
+from types import MappingProxyType
 from typing import Dict
 from typing import List
 from typing import Optional
 
+from oidcmsg.configure import DEFAULT_DIR_ATTRIBUTE_NAMES
+from oidcmsg.configure import DEFAULT_FILE_ATTRIBUTE_NAMES
 from oidcmsg.configure import Base
+from oidcmsg.configure import Configuration as BaseConfiguration
+from oidcmsg.configure import add_path_to_directory_name
+from oidcmsg.configure import add_path_to_filename
 
 from oidcop.scopes import SCOPE2CLAIMS
+from oidcop.utils import load_yaml_config
 
 logger = logging.getLogger(__name__)
 
+FILE_ATTRIBUTE_NAMES = frozenset(DEFAULT_FILE_ATTRIBUTE_NAMES)
+DIR_ATTRIBUTE_NAMES = frozenset(DEFAULT_DIR_ATTRIBUTE_NAMES)
+URIS = frozenset(["issuer", "base_url"])
+
+
+def _freeze(conf):
+    """
+    Makes a read-only copy of a configuration. Dictionaries become mapping proxies
+    and lists become tuples.
+
+    :param conf: A configuration or a part of one
+    :return: The read-only copy
+    """
+    if isinstance(conf, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in conf.items()})
+    elif isinstance(conf, list):
+        return tuple(_freeze(v) for v in conf)
+    return conf
+
+
 OP_DEFAULT_CONFIG = {
     "capabilities": {
         "subject_types_supported": ["public", "pairwise"],
@@ -83,16 +115,144 @@ OP_DEFAULT_CONFIG = {
     "scopes_to_claims": SCOPE2CLAIMS,
 }
 
-AS_DEFAULT_CONFIG = copy.deepcopy(OP_DEFAULT_CONFIG)
-AS_DEFAULT_CONFIG["claims_interface"] = {
-    "class": "oidcop.session.claims.OAuth2ClaimsInterface",
-    "kwargs": {},
-}
+AS_DEFAULT_CONFIG = _freeze(
+    {
+        **OP_DEFAULT_CONFIG,
+        "claims_interface": {
+            "class": "oidcop.session.claims.OAuth2ClaimsInterface",
+            "kwargs": {},
+        },
+    }
+)
+# The defaults, and DEFAULT_EXTENDED_CONF below, are read-only. They can be given
+# as conf to the configuration classes, but copy.deepcopy() does not work on them.
+OP_DEFAULT_CONFIG = _freeze(OP_DEFAULT_CONFIG)
+
+
+def _thaw(conf):
+    """
+    Makes a modifiable copy of a configuration frozen by _freeze. Mapping proxies
+    become dictionaries and tuples become lists.
+
+    :param conf: A frozen configuration or a part of one
+    :return: The modifiable copy
+    """
+    if isinstance(conf, MappingProxyType):
+        return {k: _thaw(v) for k, v in conf.items()}
+    elif isinstance(conf, tuple):
+        return [_thaw(v) for v in conf]
+    return conf
+
+
+def _copy_conf(conf):
+    """
+    Copies the dictionaries and lists of a configuration. Everything else (strings,
+    numbers, tuples, classes, functions, ...) is shared with the original.
+    This is all the protection needed against the in place formatting of the
+    configuration and much cheaper than a deep copy.
+    Frozen defaults (mapping proxies) are thawed, subclasses of dict and list are
+    deep copied so they keep their type.
+
+    :param conf: A configuration or a part of one
+    :return: A copy
+    """
+    if type(conf) is dict:
+        return {k: _copy_conf(v) for k, v in conf.items()}
+    elif type(conf) is list:
+        return [_copy_conf(v) for v in conf]
+    elif isinstance(conf, MappingProxyType):
+        return _thaw(conf)
+    elif isinstance(conf, (dict, list)):
+        return copy.deepcopy(conf)
+    return conf
+
+
+# Top level parts of a configuration that hold none of the default file/directory/URI
+# attributes
+_SKIP_SUBTREES = frozenset(["capabilities", "httpc_params", "scopes_to_claims"])
+
+
+def _normalize_conf(
+        conf: dict,
+        base_path: str,
+        file_attributes: Optional[List[str]],
+        dir_attributes: Optional[List[str]],
+        uris: List[str],
+        domain: str,
+        port: int,
+):
+    """
+    Makes references to files and directories absolute and replaces {domain} and {port}
+    in the values of the URI attributes. Both are done in one walk over the
+    configuration. The change is done in place.
+
+    :param conf: The configuration
+    :param base_path: The base path used to make references absolute
+    :param file_attributes: Names of the attributes that refer to files
+    :param dir_attributes: Names of the attributes that refer to directories
+    :param uris: Names of the attributes that are URIs
+    :param domain: The domain name
+    :param port: The port used
+    :return: The configuration
+    """
+    if not base_path:
+        file_attributes = dir_attributes = frozenset()
+    else:
+        if not isinstance(file_attributes, frozenset):
+            file_attributes = frozenset(file_attributes or [])
+        if not isinstance(dir_attributes, frozenset):
+            dir_attributes = frozenset(dir_attributes or [])
+    if not isinstance(uris, frozenset):
+        uris = frozenset(uris)
+
+    # The skipped parts are only known to lack the default attribute names
+    if (
+            file_attributes <= FILE_ATTRIBUTE_NAMES
+            and dir_attributes <= DIR_ATTRIBUTE_NAMES
+            and uris <= URIS
+    ):
+        skip = _SKIP_SUBTREES
+    else:
+        skip = frozenset()
+
+    # Mostly plain dicts and lists, so the cheap exact type test goes first, but
+    # subclasses (OrderedDict and the like) are walked too.
+    stack = [conf]
+    while stack:
+        _conf = stack.pop()
+        for key, val in _conf.items():
+            if key in file_attributes:
+                val = _conf[key] = add_path_to_filename(val, base_path)
+            if key in dir_attributes:
+                val = _conf[key] = add_path_to_directory_name(val, base_path)
+
+            if key in uris:
+                if not val:
+                    continue
+
+                # Most URIs are complete, only format those with a placeholder
+                if type(val) is list or isinstance(val, list):
+                    _conf[key] = [
+                        v.format(domain=domain, port=port) if "{" in v else v for v in val
+                    ]
+                elif "{" in val:
+                    _conf[key] = val.format(domain=domain, port=port)
+            elif type(val) is dict or isinstance(val, dict):
+                if _conf is conf and key in skip:
+                    continue
+                stack.append(val)
+    return conf
+
+
+# (class, parameter) -> (frozen default, format arguments, formatted default)
+_FORMATTED_DEFAULTS = {}
 
 
 class EntityConfiguration(Base):
     default_config = AS_DEFAULT_CONFIG
-    uris = ["issuer", "base_url"]
+    uris = URIS
+    # __init__ takes normalized, see Configuration.extend
+    accepts_normalized_conf = True
     parameter = {
         "add_on": None,
         "authz": None,
@@ -121,26 +281,52 @@ class EntityConfiguration(Base):
             port: Optional[int] = 0,
             file_attributes: Optional[List[str]] = None,
             dir_attributes: Optional[List[str]] = None,
+            normalized: Optional[bool] = False,
     ):
 
-        conf = copy.deepcopy(conf)
-        Base.__init__(self, conf, base_path, file_attributes, dir_attributes=dir_attributes)
-
-        for key in self.parameter.keys():
-            _val = conf.get(key)
-            if not _val:
-                if key in self.default_config:
-                    _val = copy.deepcopy(self.default_config[key])
-                    self.format(
-                        _val,
-                        base_path=base_path,
-                        file_attributes=file_attributes,
-                        domain=domain,
-                        port=port,
-                        dir_attributes=dir_attributes
-                    )
-                else:
-                    continue
+        conf = _copy_conf(conf)
+
+        # This deliberately mirrors oidcmsg.configure.Base.__init__ (oidcmsg is pinned
+        # in setup.py) rather than calling it, so that base path, domain and port are
+        # applied in the single walk of _normalize_conf. Keep the two in step when
+        # the oidcmsg version is bumped.
+        dict.__init__(self)
+        self._file_attributes = file_attributes or DEFAULT_FILE_ATTRIBUTE_NAMES
+        self._dir_attributes = dir_attributes or DEFAULT_DIR_ATTRIBUTE_NAMES
+
+        # entity info
+        self.domain = conf.get("domain", "127.0.0.1")
+        self.port = conf.get("port", 80)
+
+        if normalized:
+            # base path and domain/port already applied by the enclosing Configuration
+            self.conf = conf
+        else:
+            self.conf = _normalize_conf(
+                conf,
+                base_path,
+                file_attributes or FILE_ATTRIBUTE_NAMES,
+                dir_attributes or DIR_ATTRIBUTE_NAMES,
+                self.uris,
+                self.domain,
+                self.port,
+            )
+
+        # Parameters with a non-empty configured value, the rest of the parameters
+        # that have a default value. Worked out with set operations on the key views.
+        _keys = self.parameter.keys()
+        _given = {key for key in _keys & conf.keys() if conf[key]}
+        _defaulted = (_keys & self.default_config.keys()) - _given
+
+        for key in _keys:
+            if key in _given:
+                _val = conf[key]
+            elif key in _defaulted:
+                _val = self._default_value(
+                    key, base_path, file_attributes, dir_attributes, domain, port
+                )
+            else:
+                continue
 
             if key not in DEFAULT_EXTENDED_CONF:
                 logger.warning(f"{key} not seems to be a valid configuration parameter")
@@ -154,10 +340,65 @@ class EntityConfiguration(Base):
 
             setattr(self, key, _val)
 
+    def _default_value(self, key, base_path, file_attributes, dir_attributes, domain, port):
+        """
+        Returns a formatted, modifiable copy of the default value of key.
+        A frozen default is formatted once per set of arguments. Later instances
+        find it by the identity of the default and only have to copy it.
+        """
+        _default = self.default_config[key]
+        if not isinstance(_default, (MappingProxyType, tuple)):
+            # default_config of a subclass need not be frozen
+            _val = _copy_conf(_default)
+            self.format(
+                _val,
+                base_path=base_path,
+                file_attributes=file_attributes,
+                domain=domain,
+                port=port,
+                dir_attributes=dir_attributes,
+            )
+            return _val
+
+        _args = (base_path, file_attributes, dir_attributes, domain, port)
+        _cached = _FORMATTED_DEFAULTS.get((type(self), key))
+        if _cached is None or _cached[0] is not _default or _cached[1] != _args:
+            _val = _thaw(_default)
+            self.format(
+                _val,
+                base_path=base_path,
+                file_attributes=file_attributes,
+                domain=domain,
+                port=port,
+                dir_attributes=dir_attributes,
+            )
+            _cached = (_default, _args, _freeze(_val))
+            _FORMATTED_DEFAULTS[(type(self), key)] = _cached
+        return _thaw(_cached[2])
+
+    def format(
+            self,
+            conf,
+            base_path: str,
+            domain: str,
+            port: int,
+            file_attributes: Optional[List[str]] = None,
+            dir_attributes: Optional[List[str]] = None,
+    ) -> None:
+        """
+        Formats parts of the configuration. Same as Base.format but done in one walk
+        over the configuration.
+        """
+        if isinstance(conf, dict):
+            _normalize_conf(
+                conf, base_path, file_attributes, dir_attributes, self.uris, domain, port
+            )
+
 
 class OPConfiguration(EntityConfiguration):
     "Provider configuration"
     default_config = OP_DEFAULT_CONFIG
+    accepts_normalized_conf = True
     parameter = EntityConfiguration.parameter.copy()
     parameter.update(
         {
@@ -178,6 +419,7 @@ class OPConfiguration(EntityConfiguration):
             port: Optional[int] = 0,
             file_attributes: Optional[List[str]] = None,
             dir_attributes: Optional[List[str]] = None,
+            normalized: Optional[bool] = False,
     ):
         super().__init__(
             conf=conf,
@@ -186,12 +428,14 @@ class OPConfiguration(EntityConfiguration):
             domain=domain,
             port=port,
             file_attributes=file_attributes,
-            dir_attributes=dir_attributes
+            dir_attributes=dir_attributes,
+            normalized=normalized,
         )
 
 
 class ASConfiguration(EntityConfiguration):
     "Authorization server configuration"
+    accepts_normalized_conf = True
 
     def __init__(
             self,
@@ -202,6 +446,7 @@ class ASConfiguration(EntityConfiguration):
             port: Optional[int] = 0,
             file_attributes: Optional[List[str]] = None,
             dir_attributes: Optional[List[str]] = None,
+            normalized: Optional[bool] = False,
     ):
         EntityConfiguration.__init__(
             self,
@@ -211,10 +456,177 @@ class ASConfiguration(EntityConfiguration):
             domain=domain,
             port=port,
             file_attributes=file_attributes,
-            dir_attributes=dir_attributes
+            dir_attributes=dir_attributes,
+            normalized=normalized,
         )
 
 
+class Configuration(BaseConfiguration):
+    """Server configuration"""
+
+    def extend(
+            self,
+            conf: Dict,
+            base_path: str,
+            domain: str,
+            port: int,
+            entity_conf: Optional[List[dict]] = None,
+            file_attributes: Optional[List[str]] = None,
+            dir_attributes: Optional[List[str]] = None,
+    ):
+        """
+        Same as BaseConfiguration.extend, but entity configurations that would format
+        their part of the configuration in the same way as was already done here, are
+        told not to do it again.
+        """
+        for econf in entity_conf:
+            _path = econf.get("path")
+            _cnf = conf
+            if _path:
+                for step in _path:
+                    _cnf = _cnf[step]
+            _attr = econf["attr"]
+            _cls = econf["class"]
+            _kwargs = {}
+            # Only trusted when set on the class itself, a subclass may have an
+            # __init__ that does not take normalized.
+            if (
+                    isinstance(_cls, type)
+                    and vars(_cls).get("accepts_normalized_conf", False)
+                    and set(_cls.uris) <= set(self.uris)
+            ):
+                _kwargs["normalized"] = True
+            setattr(
+                self,
+                _attr,
+                _cls(
+                    _cnf,
+                    base_path=base_path,
+                    file_attributes=file_attributes,
+                    domain=domain,
+                    port=port,
+                    dir_attributes=dir_attributes,
+                    **_kwargs,
+                ),
+            )
+
+
+# Configurations read from Python files, absolute path -> (modification time, configuration)
+_PY_CONF_CACHE = {}
+
+
+def _load_yaml_with_cache(filename: str) -> dict:
+    """
+    Load a YAML configuration file. The parsed result is stored as JSON next to the
+    YAML file, together with the modification time and size of the YAML file, and
+    reused as long as both are unchanged.
+
+    :param filename: Name of the YAML file
+    :return: The parsed configuration
+    """
+    _cache = filename + ".cache.json"
+    _stat = os.stat(filename)
+    _source = {"mtime_ns": _stat.st_mtime_ns, "size": _stat.st_size}
+    try:
+        with open(_cache, "rb") as fp:
+            _cached = json.loads(fp.read())
+    except (OSError, ValueError):
+        pass
+    else:
+        if isinstance(_cached, dict) and _cached.get("source") == _source and "conf" in _cached:
+            return _cached["conf"]
+
+    _conf = load_yaml_config(filename)
+
+    # Only cache what survives a JSON round trip unchanged (no dates, no integer keys ...)
+    try:
+        _str = json.dumps({"source": _source, "conf": _conf})
+    except (TypeError, ValueError):
+        return _conf
+    if json.loads(_str)["conf"] != _conf:
+        return _conf
+
+    # The cache holds the same secrets as the YAML file, so it gets the same permissions.
+    # mkstemp gives every writer its own temporary file.
+    _tmp = None
+    try:
+        _fd, _tmp = tempfile.mkstemp(dir=os.path.dirname(_cache) or ".")
+        with os.fdopen(_fd, "w") as fp:
+            os.chmod(_tmp, stat.S_IMODE(_stat.st_mode))
+            fp.write(_str)
+        os.replace(_tmp, _cache)
+    except OSError as err:
+        logger.debug(f"Could not cache configuration in {_cache}: {err}")
+        if _tmp and os.path.exists(_tmp):
+            os.remove(_tmp)
+    return _conf
+
+
+def _load_py_config(filename: str) -> dict:
+    """
+    Load a configuration from the CONFIG attribute of a Python file. The result is
+    cached for as long as the file is not modified.
+
+    :param filename: Name of the Python file
+    :return: The configuration
+    """
+    _path = os.path.abspath(filename)
+    _mtime = os.stat(_path).st_mtime
+    _cached = _PY_CONF_CACHE.get(_path)
+    if _cached is not None and _cached[0] == _mtime:
+        return _cached[1]
+
+    # Load the file as a module of its own, without touching sys.path or sys.modules
+    _name = "_oidcop_conf_" + hashlib.sha256(_path.encode()).hexdigest()
+    spec = importlib.util.spec_from_file_location(_name, _path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    _conf = getattr(module, "CONFIG")
+    # A modified file replaces the entry of its older version
+    _PY_CONF_CACHE[_path] = (_mtime, _conf)
+    return _conf
+
+
+def create_from_config_file(
+        cls,
+        filename: str,
+        base_path: Optional[str] = "",
+        entity_conf: Optional[List[dict]] = None,
+        file_attributes: Optional[List[str]] = None,
+        domain: Optional[str] = "",
+        port: Optional[int] = 0,
+        dir_attributes: Optional[List[str]] = None,
+):
+    """
+    Create a configuration instance from the content of a file. The file type is
+    decided by the file name extension and can be one of YAML, JSON or Python.
+
+    :param cls: The configuration class
+    :param filename: Name of the configuration file
+    :return: An instance of cls
+    """
+    if filename.endswith(".yaml"):
+        _cnf = _load_yaml_with_cache(filename)
+    elif filename.endswith(".json"):
+        with open(filename, "rb") as fp:
+            _cnf = json.loads(fp.read())
+    elif filename.endswith(".py"):
+        # the cached configuration must not be changed by the formatting
+        _cnf = _copy_conf(_load_py_config(filename))
+    else:
+        raise ValueError("Unknown file type")
+
+    return cls(
+        _cnf,
+        entity_conf=entity_conf,
+        base_path=base_path,
+        file_attributes=file_attributes,
+        domain=domain,
+        port=port,
+        dir_attributes=dir_attributes,
+    )
+
+
 DEFAULT_EXTENDED_CONF = {
     "add_on": {
         "pkce": {
@@ -460,3 +872,6 @@ DEFAULT_EXTENDED_CONF = {
         },
     },
 }
+
+
+DEFAULT_EXTENDED_CONF = _freeze(DEFAULT_EXTENDED_CONF)
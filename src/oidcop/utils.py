@@ -6,6 +6,11 @@ import sys
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeLoader
+
 
 def load_json(file_name):  # pragma: no cover
     with open(file_name) as fp:
@@ -15,7 +20,7 @@ def load_json(file_name):  # pragma: no cover
 
 def load_yaml_config(file_name):
     with open(file_name) as fp:
-        c = yaml.safe_load(fp)
+        c = yaml.load(fp, Loader=SafeLoader)
     return c
 
 
@@ -1,11 +1,19 @@
+from collections import OrderedDict
 import json
 import os
+import shutil
+import stat
 
 from oidcmsg.configure import Configuration
 from oidcmsg.configure import create_from_config_file
 import pytest
 
+from oidcop.configure import DEFAULT_EXTENDED_CONF
+from oidcop.configure import OP_DEFAULT_CONFIG
+from oidcop.configure import _PY_CONF_CACHE
+from oidcop.configure import Configuration as OPServerConfiguration
 from oidcop.configure import OPConfiguration
+from oidcop.configure import create_from_config_file as op_create_from_config_file
 from oidcop.logging import configure_logging
 
 BASEDIR = os.path.abspath(os.path.dirname(__file__))
@@ -39,6 +47,9 @@ def test_op_configure():
 
     assert "session_params" in configuration
 
+    # The configuration can still be serialized
+    assert json.loads(json.dumps(configuration))
+
 
 def test_op_configure_from_file():
     configuration = create_from_config_file(
@@ -81,6 +92,77 @@ def test_op_configure_default():
     }
 
 
+def test_op_configure_default_not_shared():
+    configuration = OPConfiguration(conf={}, base_path=BASEDIR, domain="127.0.0.1", port=443)
+    configuration["cookie_handler"]["kwargs"]["name"]["session"] = "changed"
+    assert OP_DEFAULT_CONFIG["cookie_handler"]["kwargs"]["name"]["session"] == "oidc_op"
+
+    with pytest.raises(TypeError):
+        OP_DEFAULT_CONFIG["issuer"] = "https://example.com"
+
+
+def test_op_configure_from_extended_default():
+    with pytest.raises(TypeError):
+        DEFAULT_EXTENDED_CONF["issuer"] = "https://example.com"
+
+    configuration = OPConfiguration(
+        conf=DEFAULT_EXTENDED_CONF, base_path=BASEDIR, domain="127.0.0.1", port=443
+    )
+    assert configuration["add_on"]["pkce"]["kwargs"]["essential"] is False
+
+
+def test_op_configure_formatted_default_not_shared():
+    first = OPConfiguration(conf={}, base_path=BASEDIR, domain="127.0.0.1", port=443)
+    first["cookie_handler"]["kwargs"]["name"]["session"] = "changed"
+    second = OPConfiguration(conf={}, base_path=BASEDIR, domain="127.0.0.1", port=443)
+    assert second["cookie_handler"]["kwargs"]["name"]["session"] == "oidc_op"
+    assert second["cookie_handler"] == OPConfiguration(conf={}, base_path=BASEDIR)["cookie_handler"]
+
+
+def test_op_configure_custom_file_attributes():
+    configuration = OPConfiguration(
+        conf={"httpc_params": {"verify": "ca.pem"}},
+        base_path=BASEDIR,
+        file_attributes=["verify"],
+    )
+    assert configuration["httpc_params"]["verify"] == os.path.join(BASEDIR, "ca.pem")
+
+
+def test_op_configure_keeps_container_types():
+    configuration = OPConfiguration(
+        conf={
+            "httpc_params": {"cert": ("a.pem", "b.pem")},
+            "add_on": OrderedDict(pkce={"function": "oidcop.oidc.add_on.pkce.add_pkce_support"}),
+        },
+        base_path=BASEDIR,
+    )
+    assert configuration["httpc_params"]["cert"] == ("a.pem", "b.pem")
+    assert isinstance(configuration["add_on"], OrderedDict)
+
+
+def test_op_configure_format_dict_subclass():
+    configuration = OPConfiguration(conf={}, base_path=BASEDIR)
+    conf = OrderedDict(
+        userinfo=OrderedDict(kwargs=OrderedDict(db_file="users.json")),
+        endpoint=OrderedDict(info=OrderedDict(issuer="https://{domain}:{port}")),
+    )
+    configuration.format(
+        conf, base_path=BASEDIR, domain="example.com", port=8443, file_attributes=["db_file"]
+    )
+    assert conf["userinfo"]["kwargs"]["db_file"] == os.path.join(BASEDIR, "users.json")
+    assert conf["endpoint"]["info"]["issuer"] == "https://example.com:8443"
+
+
+def test_op_configure_from_frozen_default():
+    configuration = OPConfiguration(
+        conf=OP_DEFAULT_CONFIG, base_path=BASEDIR, domain="127.0.0.1", port=443
+    )
+    _kwargs = configuration["cookie_handler"]["kwargs"]
+    assert isinstance(_kwargs, dict)
+    assert isinstance(_kwargs["keys"]["key_defs"], list)
+    assert _kwargs["keys"]["private_path"].startswith(BASEDIR)
+
+
 def test_op_configure_default_from_file():
     configuration = create_from_config_file(
         OPConfiguration,
@@ -127,6 +209,169 @@ def test_server_configure():
     assert userinfo_conf["kwargs"]["db_file"].startswith(BASEDIR)
 
 
+def test_op_configure_from_py_file():
+    configuration = op_create_from_config_file(
+        OPConfiguration,
+        filename=full_path("op_config_defaults.py"),
+        base_path=BASEDIR,
+        domain="127.0.0.1",
+        port=443,
+    )
+    assert "authentication" in configuration
+    userinfo_conf = configuration.get("userinfo")
+    assert userinfo_conf["kwargs"]["filename"].startswith(BASEDIR)
+
+    again = op_create_from_config_file(
+        OPConfiguration,
+        filename=full_path("op_config_defaults.py"),
+        base_path=BASEDIR,
+        domain="127.0.0.1",
+        port=443,
+    )
+    assert again["userinfo"] == userinfo_conf
+
+
+def test_op_configure_py_file_modified(tmp_path):
+    _file = tmp_path / "op_config.py"
+    _file.write_text('CONFIG = {"issuer": "https://one.example.com"}\n')
+    configuration = op_create_from_config_file(OPConfiguration, filename=str(_file))
+    assert configuration["issuer"] == "https://one.example.com"
+
+    _file.write_text('CONFIG = {"issuer": "https://two.example.com"}\n')
+    _stat = os.stat(_file)
+    os.utime(_file, ns=(_stat.st_atime_ns, _stat.st_mtime_ns + 10 ** 9))
+    configuration = op_create_from_config_file(OPConfiguration, filename=str(_file))
+    assert configuration["issuer"] == "https://two.example.com"
+    assert _PY_CONF_CACHE[str(_file)][1] == {"issuer": "https://two.example.com"}
+
+
+def test_op_server_configure(tmp_path):
+    _file = str(tmp_path / "srv_config.yaml")
+    shutil.copy(full_path("srv_config.yaml"), _file)
+
+    configuration = op_create_from_config_file(
+        OPServerConfiguration,
+        entity_conf=[{"class": OPConfiguration, "attr": "op", "path": ["op", "server_info"]}],
+        filename=_file,
+        base_path=BASEDIR,
+    )
+    op_conf = configuration["op"]
+    assert "key_conf" in op_conf
+    assert "{" not in op_conf["issuer"]
+    userinfo_conf = op_conf.get("userinfo")
+    assert userinfo_conf["kwargs"]["db_file"].startswith(BASEDIR)
+
+
+def test_op_server_configure_relative_base_path(tmp_path, monkeypatch):
+    _file = str(tmp_path / "srv_config.yaml")
+    shutil.copy(full_path("srv_config.yaml"), _file)
+    # the logging configuration writes to conf/debug.log
+    (tmp_path / "conf").mkdir()
+    monkeypatch.chdir(tmp_path)
+
+    configuration = op_create_from_config_file(
+        OPServerConfiguration,
+        entity_conf=[{"class": OPConfiguration, "attr": "op", "path": ["op", "server_info"]}],
+        filename=_file,
+        base_path="conf",
+    )
+    userinfo_conf = configuration["op"]["userinfo"]
+    assert userinfo_conf["kwargs"]["db_file"] == os.path.join("conf", "users.json")
+
+
+class OldStyleOPConfiguration(OPConfiguration):
+    def __init__(self, conf, base_path="", entity_conf=None, domain="", port=0,
+                 file_attributes=None, dir_attributes=None):
+        OPConfiguration.__init__(self, conf, base_path=base_path, domain=domain, port=port,
+                                 file_attributes=file_attributes,
+                                 dir_attributes=dir_attributes)
+
+
+def _op_conf_factory(conf, **kwargs):
+    return OPConfiguration(conf, **kwargs)
+
+
+@pytest.mark.parametrize("entity_class", [OldStyleOPConfiguration, _op_conf_factory])
+def test_op_server_configure_other_entity_class(tmp_path, entity_class):
+    _file = str(tmp_path / "srv_config.yaml")
+    shutil.copy(full_path("srv_config.yaml"), _file)
+
+    configuration = op_create_from_config_file(
+        OPServerConfiguration,
+        entity_conf=[{"class": entity_class, "attr": "op", "path": ["op", "server_info"]}],
+        filename=_file,
+        base_path=BASEDIR,
+    )
+    userinfo_conf = configuration["op"]["userinfo"]
+    assert userinfo_conf["kwargs"]["db_file"] == os.path.join(BASEDIR, "users.json")
+
+
+def test_server_configure_yaml_cache(tmp_path):
+    _file = str(tmp_path / "srv_config.yaml")
+    shutil.copy(full_path("srv_config.yaml"), _file)
+
+    entity_conf = [{"class": OPConfiguration, "attr": "op", "path": ["op", "server_info"]}]
+    configuration = op_create_from_config_file(
+        Configuration, entity_conf=entity_conf, filename=_file, base_path=BASEDIR
+    )
+    assert os.path.exists(_file + ".cache.json")
+
+    cached = op_create_from_config_file(
+        Configuration, entity_conf=entity_conf, filename=_file, base_path=BASEDIR
+    )
+    assert cached.conf == configuration.conf
+    assert cached["op"]["issuer"] == configuration["op"]["issuer"]
+
+
+def test_yaml_cache_is_used(tmp_path):
+    _file = str(tmp_path / "conf.yaml")
+    with open(_file, "w") as fp:
+        fp.write("foo: bar\n")
+
+    configuration = op_create_from_config_file(Configuration, filename=_file)
+    assert configuration.conf["foo"] == "bar"
+
+    # Change the cached configuration, the change should show up
+    with open(_file + ".cache.json") as fp:
+        _cached = json.load(fp)
+    _cached["conf"]["foo"] = "cached"
+    with open(_file + ".cache.json", "w") as fp:
+        json.dump(_cached, fp)
+
+    configuration = op_create_from_config_file(Configuration, filename=_file)
+    assert configuration.conf["foo"] == "cached"
+
+
+def test_yaml_cache_invalidated(tmp_path):
+    _file = str(tmp_path / "conf.yaml")
+    with open(_file, "w") as fp:
+        fp.write("foo: bar\n")
+    _stat = os.stat(_file)
+
+    configuration = op_create_from_config_file(Configuration, filename=_file)
+    assert configuration.conf["foo"] == "bar"
+
+    # Same size, older modification time, like a restored backup
+    with open(_file, "w") as fp:
+        fp.write("foo: baz\n")
+    os.utime(_file, ns=(_stat.st_atime_ns, _stat.st_mtime_ns - 10 ** 9))
+
+    configuration = op_create_from_config_file(Configuration, filename=_file)
+    assert configuration.conf["foo"] == "baz"
+
+
+def test_yaml_cache_permissions(tmp_path):
+    _file = str(tmp_path / "conf.yaml")
+    with open(_file, "w") as fp:
+        fp.write("secret: sauce\n")
+    os.chmod(_file, 0o600)
+
+    op_create_from_config_file(Configuration, filename=_file)
+    assert stat.S_IMODE(os.stat(_file + ".cache.json").st_mode) == 0o600
+    # no temporary files left behind
+    assert set(os.listdir(str(tmp_path))) == {"conf.yaml", "conf.yaml.cache.json"}
+
+
 def test_loggin_conf_file():
     logger = configure_logging(filename=full_path("logging.yaml"))
     assert logger